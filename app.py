@@ -1,17 +1,27 @@
 import streamlit as st
 import pandas as pd
 import geopandas as gpd
+import shapely
+import pyogrio
 from shapely.geometry import Point, LineString, MultiLineString
-from shapely.ops import substring, linemerge
+from shapely.ops import linemerge
 import folium
 from folium import JsCode
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 import requests
 import io
+import json
 import os
+import re
 import shutil
+import tempfile
+import time
+import hashlib
+import logging
 import numpy as np 
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 
 # --- ARCGIS LIBRARY CHECK & PATCH ---
 try:
@@ -31,6 +41,13 @@ except ImportError:
 except Exception:
     ARCGIS_AVAILABLE = True 
 
+# --- CALAMINE CHECK ---
+try:
+    import python_calamine
+    CALAMINE_AVAILABLE = True
+except ImportError:
+    CALAMINE_AVAILABLE = False
+
 # --- PAGE CONFIG ---
 st.set_page_config(
     page_title="CDOT Route and Reference Mapper Developed with Gemini",
@@ -114,91 +131,319 @@ st.divider()
 ROUTE_SERVICE_URL = "https://services.arcgis.com/yzB9WM8W0BO3Ql7d/arcgis/rest/services/Routes_gdb/FeatureServer/0"
 CALC_CRS = "EPSG:3857" # Meters
 MAP_CRS = "EPSG:4326"  # Lat/Long
+MAP_SIMPLIFY_M = 2.0   # Display-only line simplification tolerance (meters)
+PAGE_SIZE = 2000       # Features requested per ArcGIS query page
+FETCH_WORKERS = 8      # Concurrent page requests
+ROUTE_CACHE_TTL_S = 24 * 3600  # Max age of the on-disk route network copy
+PARALLEL_MIN_ROWS = 10000      # Rows per worker before process_batch is split across threads
 
 # --- STATE MANAGEMENT ---
-if 'success_pts' not in st.session_state: st.session_state['success_pts'] = []
-if 'success_lns' not in st.session_state: st.session_state['success_lns'] = []
+if 'pts_gdf_out' not in st.session_state: st.session_state['pts_gdf_out'] = None
+if 'lns_gdf_out' not in st.session_state: st.session_state['lns_gdf_out'] = None
 if 'error_df' not in st.session_state: st.session_state['error_df'] = None
 if 'processed' not in st.session_state: st.session_state['processed'] = False
 if 'gis' not in st.session_state: st.session_state['gis'] = None
 if 'user_layers' not in st.session_state: st.session_state['user_layers'] = []
 if 'user_folders' not in st.session_state: st.session_state['user_folders'] = []
 if 'portal_url' not in st.session_state: st.session_state['portal_url'] = "https://maps.codot.gov/portal/"
+if 'map_html' not in st.session_state: st.session_state['map_html'] = None
+if 'map_color' not in st.session_state: st.session_state['map_color'] = None
+if 'schema_check' not in st.session_state: st.session_state['schema_check'] = None
 
 # --- UTILS ---
-@st.cache_data
+logger = logging.getLogger(__name__)
+
+class RouteDownloadError(Exception):
+    # The route service answered, but not with every feature it reports having
+    pass
+
+def normalize_rid(series):
+    return series.astype(str).str.strip()
+
+def find_route_id_col(columns):
+    for c in columns:
+        if str(c).upper() in ['ROUTE', 'ROUTEID', 'RTEID', 'ROUTE_ID']:
+            return c
+    return columns[0]
+
+def merge_route_geom(geom):
+    if geom is not None and geom.geom_type == 'MultiLineString':
+        merged = linemerge(geom)
+        if merged.geom_type in ['LineString', 'MultiLineString']:
+            return merged
+    return geom
+
+def read_csv_upload(f):
+    # pyarrow is the fast path, but it is stricter than the C engine: short rows raise, and duplicate or
+    # blank headers are kept as-is instead of becoming 'X.1' / 'Unnamed: N'. Those files are re-read the old way.
+    try:
+        df = pd.read_csv(f, engine='pyarrow')
+        if not (df.columns.duplicated().any() or (df.columns == '').any()): return df
+    except (pd.errors.ParserError, ValueError):
+        pass
+    f.seek(0)
+    return pd.read_csv(f)
+
+def stringify_datetimes(gdf):
+    # GeoJSON/OGR writers choke on Timestamps; cast every datetime column in one go
+    dt_cols = gdf.select_dtypes(include=['datetime', 'datetimetz']).columns
+    if len(dt_cols): gdf[dt_cols] = gdf[dt_cols].astype(str)
+    return gdf
+
+def find_segs(feat_table, lens, codes, targets):
+    # Per row: rank of the first feature of its route long enough to hold the measure, -1 if none is.
+    # One vectorized pass per feature rank over the rows still unplaced, like the line loop.
+    out = np.full(len(codes), -1)
+    pending = np.arange(len(codes))
+    for j in range(feat_table.shape[1]):
+        if not len(pending): break
+        feat = feat_table[codes[pending], j]
+        has = feat >= 0
+        hit = has & (targets[pending] <= lens[feat])
+        out[pending[hit]] = j
+        pending = pending[has & ~hit]
+    return out
+
+@st.cache_resource
 def get_arcgis_features(service_url):
-    all_features = []
-    offset = 0
-    with st.spinner("Fetching Official CDOT Route Network... (One time load)"):
-        while True:
+    # Prepared network is also kept on disk as GeoParquet so restarts skip the download
+    cache_path = f"/tmp/routes_{hashlib.md5(service_url.encode()).hexdigest()}.parquet"
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ROUTE_CACHE_TTL_S:
+        try: return gpd.read_parquet(cache_path)
+        except Exception as e: logger.warning("Route cache %s unreadable, downloading again: %s", cache_path, e)
+    
+    pages = []
+    expected = None  # Feature count the server reports, to tell a full download from a partial one
+    failed = False
+    with st.spinner("Fetching Official CDOT Route Network... (One time load)"), requests.Session() as session:
+        def read_page(r):
+            # GDAL parses the page straight into arrays; paging stays ours, not the driver's
+            r.raise_for_status()
+            more = re.search(rb'"exceededTransferLimit"\s*:\s*true', r.content) is not None
+            return pyogrio.read_dataframe(io.BytesIO(r.content), FEATURE_SERVER_PAGING='NO'), more
+
+        def fetch_page(offset):
             params = {
                 'where': '1=1', 'outFields': '*', 'f': 'geojson',
-                'resultOffset': offset, 'resultRecordCount': 2000
+                'resultOffset': offset, 'resultRecordCount': PAGE_SIZE
             }
+            return read_page(session.get(f"{service_url}/query", params=params))
+
+        def fetch_ids(ids):
+            # POST keeps a couple thousand OBJECTIDs out of the URL
+            data = {'objectIds': ','.join(map(str, ids)), 'outFields': '*', 'f': 'geojson'}
+            return read_page(session.post(f"{service_url}/query", data=data))
+
+        # Preferred: OBJECTID windows. Index lookups server-side, no pagination support needed
+        try:
+            r = session.get(service_url, params={'f': 'json'})
+            page_size = min(PAGE_SIZE, int(r.json().get('maxRecordCount') or PAGE_SIZE))
+        except Exception as e:
+            logger.warning("Route service metadata unavailable, using page size %s: %s", PAGE_SIZE, e)
+            page_size = PAGE_SIZE
+        try:
+            r = session.get(f"{service_url}/query", params={'where': '1=1', 'returnIdsOnly': 'true', 'f': 'json'})
+            ids = sorted(r.json()['objectIds'] or [])
+        except Exception as e:
+            logger.warning("Route OBJECTID query failed, paging by offset: %s", e)
+            ids = []
+        if ids:
+            expected = len(ids)
             try:
-                r = requests.get(f"{service_url}/query", params=params)
-                data = r.json()
-                if 'features' not in data or not data['features']: break
-                all_features.extend(data['features'])
-                offset += len(data['features'])
-                if 'exceededTransferLimit' not in data or not data['exceededTransferLimit']: break
-            except: break
-                
-    fc = {"type": "FeatureCollection", "features": all_features}
-    gdf = gpd.GeoDataFrame.from_features(fc['features'])
-    gdf.set_crs(MAP_CRS, inplace=True)
+                windows = [ids[i:i + page_size] for i in range(0, len(ids), page_size)]
+                with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+                    results = list(ex.map(fetch_ids, windows))
+                # A truncated window means the server caps lower than advertised; page by offset instead
+                if not any(more for _, more in results):
+                    pages = [page for page, _ in results if not page.empty]
+            except Exception as e:
+                logger.warning("Route OBJECTID window failed, paging by offset: %s", e)
+                pages = []
+
+        if not pages:
+            try:
+                r = session.get(f"{service_url}/query", params={'where': '1=1', 'returnCountOnly': 'true', 'f': 'json'})
+                total = int(r.json()['count'])
+                expected = total
+            except Exception as e:
+                logger.warning("Route count query failed: %s", e)
+                total = None
+
+            offset = 0
+            while True:
+                try:
+                    page, more = fetch_page(offset)
+                    if page.empty: break
+                    pages.append(page)
+                    offset += len(page)
+                    if not more: break
+                except Exception as e:
+                    logger.warning("Route page at offset %s failed: %s", offset, e)
+                    failed = True
+                    break
+
+                # First page tells us the server's real page size; fetch the rest concurrently
+                if total:
+                    page_size = len(page)
+                    try:
+                        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+                            for page, _ in ex.map(fetch_page, range(offset, total, page_size)):
+                                if not page.empty: pages.append(page)
+                    except Exception as e:
+                        logger.warning("Route page after offset %s failed: %s", offset, e)
+                        failed = True
+                    break
+    
+    # Raising keeps a partial network out of both st.cache_resource and the disk copy
+    n = sum(len(page) for page in pages)
+    if failed or (expected is not None and n != expected):
+        raise RouteDownloadError(f"Route network download incomplete: got {n} of {expected if expected is not None else 'an unknown number of'} features.")
+    if not pages: return None
+    gdf = pd.concat(pages, ignore_index=True)
+    gdf.set_crs(MAP_CRS, inplace=True, allow_override=True)
+    gdf = prepare_route_network(gdf)
+    try:
+        gdf.to_parquet(f"{cache_path}.part")
+        os.replace(f"{cache_path}.part", cache_path)
+    except Exception as e: logger.warning("Could not write route cache %s: %s", cache_path, e)
+    return gdf
+
+def prepare_route_network(gdf):
+    # Reproject, normalize IDs and merge multilines once, inside the cached load
+    gdf = gdf.to_crs(CALC_CRS)
+    gis_rid = find_route_id_col(gdf.columns)
+    gdf[gis_rid] = normalize_rid(gdf[gis_rid])
+    gdf['geometry'] = gdf.geometry.apply(merge_route_geom)
+    gdf['_len_m'] = gdf.geometry.length
     return gdf
 
+# Everything process_batch needs from the network, built once and shared across runs
+RouteNetwork = namedtuple('RouteNetwork', ['gdf', 'gis_rid', 'index', 'net'])
+
+@st.cache_resource
+def get_route_network(service_url):
+    gdf = get_arcgis_features(service_url)
+    if gdf is None: return None
+    gis_rid = find_route_id_col(gdf.columns)
+    index, net = build_route_index(gdf, gis_rid)
+    return RouteNetwork(gdf, gis_rid, index, net)
+
+def load_route_network():
+    # A partial download raises inside the cached loaders, so nothing truncated is ever cached
+    try: return get_route_network(ROUTE_SERVICE_URL)
+    except RouteDownloadError as e:
+        st.warning(f"{e} Nothing was cached; run again to retry the download.")
+        return None
+
 @st.cache_data
 def get_reference_data(url):
     try:
         df = pd.read_csv(url)
         df.columns = [c.strip().upper() for c in df.columns]
         
-        rid_col = next((c for c in df.columns if 'ROUTE' in c), None)
-        min_col = next((c for c in df.columns if 'MINIMUM' in c and 'EXTENT' in c), None)
-        max_col = next((c for c in df.columns if 'MAXIMUM' in c and 'EXTENT' in c), None)
+        # Single pass over the headers; first match wins for each role
+        rid_col = min_col = max_col = None
+        for c in df.columns:
+            if rid_col is None and 'ROUTE' in c: rid_col = c
+            if 'EXTENT' in c:
+                if min_col is None and 'MINIMUM' in c: min_col = c
+                if max_col is None and 'MAXIMUM' in c: max_col = c
         
         if rid_col and min_col and max_col:
-            ref_dict = {}
-            for _, row in df.iterrows():
-                try:
-                    r_id = str(row[rid_col]).strip()
-                    r_min = float(row[min_col])
-                    r_max = float(row[max_col])
-                    ref_dict[r_id] = {'min': r_min, 'max': r_max}
-                except: continue
-            return ref_dict
+            # rid -> official min/max; unparseable rows are skipped, later rows win on duplicates
+            mins = pd.to_numeric(df[min_col], errors='coerce')
+            maxs = pd.to_numeric(df[max_col], errors='coerce')
+            bad = (mins.isna() & df[min_col].notna()) | (maxs.isna() & df[max_col].notna())
+            ref_df = pd.DataFrame({'min': mins, 'max': maxs}).set_axis(normalize_rid(df[rid_col]))[~bad.to_numpy()]
+            return ref_df[~ref_df.index.duplicated(keep='last')]
         return None
     except: return None
 
+# --- MAP UTILS ---
+def to_geojson_dict(gdf):
+    # GDAL serializes the layer in C; folium embeds the dict as-is instead of walking __geo_interface__ per feature
+    buf = io.BytesIO()
+    pyogrio.write_dataframe(gdf, buf, driver="GeoJSON", COORDINATE_PRECISION=7)
+    return json.loads(buf.getvalue())
+
+def build_map_html(pts_data, lns_data, color):
+    m = folium.Map(location=[39.1, -105.5], zoom_start=7, prefer_canvas=True)
+
+    if pts_data is not None and not pts_data.empty:
+        # No-op reprojection when handed the already-projected output frame
+        pts_gdf = stringify_datetimes(pts_data.to_crs(MAP_CRS))
+
+        folium.GeoJson(
+            to_geojson_dict(pts_gdf),
+            name="Mapped Points",
+            point_to_layer=JsCode(f"""
+                function(feature, latlng) {{
+                    return L.circleMarker(latlng, {{
+                        radius: 5,
+                        fillColor: '{color}',
+                        color: 'white',
+                        weight: 1,
+                        opacity: 1,
+                        fillOpacity: 0.8
+                    }});
+                }}
+            """),
+            popup=folium.GeoJsonPopup(
+                fields=[c for c in pts_gdf.columns if c != 'geometry'],
+                style="max-width: 400px; max-height: 300px; overflow-y: auto; display: block;"
+            )
+        ).add_to(m)
+
+    if lns_data is not None and not lns_data.empty:
+        # Thin vertices for display only (meters -> degrees of latitude); exports keep full geometry
+        lns_gdf = lns_data.to_crs(MAP_CRS)
+        lns_gdf = stringify_datetimes(lns_gdf.assign(geometry=lns_gdf.geometry.simplify(MAP_SIMPLIFY_M / 111320.0, preserve_topology=False)))
+        
+        folium.GeoJson(
+            to_geojson_dict(lns_gdf),
+            name="Mapped Lines",
+            style_function=lambda x: {'color': color, 'weight': 3},
+            popup=folium.GeoJsonPopup(
+                fields=[c for c in lns_gdf.columns if c != 'geometry'],
+                style="max-width: 400px; max-height: 300px; overflow-y: auto; display: block;"
+            )
+        ).add_to(m)
+
+    folium.LayerControl().add_to(m)
+    return m.get_root().render()
+
 # --- EXPORT UTILS ---
-def prep_geopackage_zip(data_list, layer_title):
-    if not data_list: return None, []
-    
-    valid_data = [d for d in data_list if d.get('geometry') is not None]
-    if not valid_data: return None, []
+def prep_geopackage_zip(data_gdf, layer_title):
+    if data_gdf is None or data_gdf.empty: return None, []
     
-    gdf = gpd.GeoDataFrame(valid_data, crs=CALC_CRS).to_crs(MAP_CRS)
-    for col in gdf.columns:
-        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
-            gdf[col] = gdf[col].astype(str)
+    # Callers pass the already-projected output frames, so this is just a copy
+    gdf = stringify_datetimes(data_gdf.to_crs(MAP_CRS))
             
-    temp_dir = f"/tmp/upload_{layer_title}"
-    if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
-    
-    gpkg_name = f"{layer_title}.gpkg"
-    # Use 'w' to ensure fresh write
-    gdf.to_file(os.path.join(temp_dir, gpkg_name), layer=layer_title, driver="GPKG", mode="w")
-    
-    zip_path = f"/tmp/{layer_title}.zip"
-    with ZipFile(zip_path, 'w') as zipf:
-        zipf.write(os.path.join(temp_dir, gpkg_name), gpkg_name)
+    # Private directory per package, so sessions publishing the same title never share files; the caller removes it.
+    # One pyogrio write in a single transaction (the portal builds its own spatial index), streamed into the zip.
+    temp_dir = tempfile.mkdtemp(prefix="upload_")
+    try:
+        gpkg_path = os.path.join(temp_dir, f"{layer_title}.gpkg")
+        pyogrio.write_dataframe(gdf, gpkg_path, layer=layer_title, driver="GPKG", SPATIAL_INDEX="NO")
+        
+        # Overwrite only cares about the archive's basename, which stays <title>.zip.
+        # Deflate level 1 still halves a GeoPackage, at about a third of the CPU of GDAL's default level.
+        zip_path = os.path.join(temp_dir, f"{layer_title}.zip")
+        with ZipFile(zip_path, 'w', compression=ZIP_DEFLATED, compresslevel=1) as zipf:
+            zipf.write(gpkg_path, f"{layer_title}.gpkg")
+        os.remove(gpkg_path)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
                 
     return zip_path, list(gdf.columns)
 
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_gis(url, username, _password, password_key, verify_cert):
+    # One authenticated connection per credential set, shared across sessions and reloads.
+    # The password itself is not hashed into the cache key (leading underscore); its sha256 is.
+    return GIS(url, username, _password, verify_cert=verify_cert)
+
 def handle_arcgis_upload(gis, zip_path, layer_title, folder_name, item_props, overwrite_item_id=None):
     try:
         # Publish Parameters to prevent Job Failed error
@@ -228,7 +473,7 @@ def handle_arcgis_upload(gis, zip_path, layer_title, folder_name, item_props, ov
             # gis.content.add() usually fails if folder name is passed but doesn't exist.
             # We'll trust the dropdown logic, but if "Create New" was used, we must create it.
             if target_folder:
-                folders = [f['title'] for f in gis.users.me.folders]
+                folders = {f['title'] for f in gis.users.me.folders}
                 if target_folder not in folders:
                     gis.content.create_folder(target_folder)
 
@@ -249,138 +494,216 @@ def handle_arcgis_upload(gis, zip_path, layer_title, folder_name, item_props, ov
     except Exception as e:
         return "ERROR", str(e)
 
+def zip_and_upload(gis, data_gdf, layer_title, folder_name, item_props, overwrite_item_id=None):
+    zip_path, _ = prep_geopackage_zip(data_gdf, layer_title)
+    if not zip_path: return None, None
+    try:
+        return handle_arcgis_upload(gis, zip_path, layer_title, folder_name, item_props, overwrite_item_id)
+    finally:
+        # The portal keeps its own copy once add()/overwrite() returns
+        shutil.rmtree(os.path.dirname(zip_path), ignore_errors=True)
+
 def check_schema_match(gis, item_id, new_columns):
     try:
         item = gis.content.get(item_id)
         if not item or not item.layers: return "UNKNOWN", []
         existing_fields = [f['name'] for f in item.layers[0].properties.fields]
-        missing_cols = [col for col in existing_fields if col not in new_columns and col.lower() not in ['fid', 'objectid', 'shape', 'globalid']]
+        new_cols, sys_cols = set(new_columns), {'fid', 'objectid', 'shape', 'globalid'}
+        missing_cols = [col for col in existing_fields if col not in new_cols and col.lower() not in sys_cols]
         return "MATCH" if not missing_cols else "MISMATCH", missing_cols
     except:
         return "UNKNOWN", []
 
-def process_batch(df_batch, routes, col_map, mode, ref_lookup=None):
+def build_route_index(routes, gis_rid):
+    # rid -> row of a padded table of its feature positions (network order), plus one flat vertex
+    # table for the whole network so interpolate/substring become searchsorted lookups, not GEOS walks
+    groups = routes.groupby(gis_rid).indices
+    n_feat = np.array([len(pos) for pos in groups.values()], dtype=int)
+    feat_table = np.full((len(groups), n_feat.max(initial=0)), -1, dtype=int)
+    for i, pos in enumerate(groups.values()): feat_table[i, :len(pos)] = pos
+    
+    geoms = routes.geometry.values
+    xy, owner = shapely.get_coordinates(geoms, return_index=True)
+    counts = np.bincount(owner, minlength=len(geoms))
+    v1 = np.cumsum(counts)
+    v0 = v1 - counts
+    step = np.r_[0.0, np.sqrt((np.diff(xy, axis=0) ** 2).sum(axis=1))]
+    # Distance restarts at every part, so MultiLineStrings measure like GEOS (gaps between parts don't count)
+    part_n = shapely.get_num_coordinates(shapely.get_parts(geoms))
+    step[(np.cumsum(part_n) - part_n)[part_n > 0]] = 0.0
+    net = {
+        'geoms': geoms, 'lens': routes['_len_m'].to_numpy(),
+        'xy': xy, 'cum': np.cumsum(step), 'v0': v0, 'v1': v1,
+        'is_line': (shapely.get_type_id(geoms) == 1) & (counts >= 2),
+        'feat_table': feat_table, 'n_feat': n_feat,
+    }
+    return pd.Index(list(groups)), net
+
+def interp_xy(net, f, d):
+    # LineString.interpolate for features f at distances d, straight off the vertex table
+    xy, cum, v0, v1 = net['xy'], net['cum'], net['v0'][f], net['v1'][f]
+    base = cum[v0]
+    target = base + np.clip(d, 0.0, cum[v1 - 1] - base)
+    i = np.clip(np.searchsorted(cum, target, 'right'), v0 + 1, v1 - 1)
+    seg = cum[i] - cum[i - 1]
+    t = np.divide(target - cum[i - 1], seg, out=np.zeros_like(seg), where=seg > 0)
+    return xy[i - 1] + t[:, None] * (xy[i] - xy[i - 1])
+
+def interpolate_points(net, f, d):
+    # Vertex table for LineStrings, GEOS for anything else (MultiLineStrings left after linemerge)
+    out = np.empty(len(f), dtype=object)
+    fast = net['is_line'][f]
+    if fast.any(): out[fast] = shapely.points(interp_xy(net, f[fast], d[fast]))
+    if (~fast).any(): out[~fast] = shapely.line_interpolate_point(net['geoms'][f[~fast]], d[~fast])
+    return out
+
+def vertex_substring(net, f, s, e):
+    # Start point, every vertex strictly between s and e, end point - straight off the vertex table.
+    # Parts of a MultiLineString are walked in order, with the gap between parts bridged directly.
+    cum, base = net['cum'], net['cum'][net['v0'][f]]
+    i0 = np.searchsorted(cum, base + s, 'right')
+    i1 = np.minimum(np.searchsorted(cum, base + e, 'left'), net['v1'][f] - 1)
+    n_in = np.maximum(i1 - i0, 0)
+    
+    # Layout per row: start point, interior vertices, end point
+    size = n_in + 2
+    o = np.cumsum(size) - size
+    coords = np.empty((size.sum(), 2))
+    coords[o] = interp_xy(net, f, s)
+    coords[o + size - 1] = interp_xy(net, f, e)
+    rel = np.arange(n_in.sum()) - np.repeat(np.cumsum(n_in) - n_in, n_in)
+    coords[np.repeat(o + 1, n_in) + rel] = net['xy'][np.repeat(i0, n_in) + rel]
+    return shapely.linestrings(coords, indices=np.repeat(np.arange(len(f)), size))
+
+def batch_substring(net, f, starts, ends):
+    # shapely.ops.substring for many (LineString feature, start, end) rows at once, with 0 <= start < end.
+    # A substring is as long as its clamped span, so rows that would come out 0.1 m or shorter are dropped
+    # arithmetically before anything is built; those and MultiLineStrings come back as None.
+    out = np.full(len(f), None, dtype=object)
+    ok = net['is_line'][f] & (np.minimum(ends, net['lens'][f]) - starts > 0.1)
+    if ok.any(): out[ok] = vertex_substring(net, f[ok], starts[ok], ends[ok])
+    return out
+
+def batch_fallback_line(net, f, bm_meters, em_meters):
+    # Fallback for broken/complex topology: rebuild the segment from the route's own vertices across its parts,
+    # clamped to the route's length. Follows the geometry exactly with O(vertices) points, whatever the length.
+    out = np.full(len(f), None, dtype=object)
+    lens = net['lens'][f]
+    s, e = np.minimum(bm_meters, lens), np.minimum(em_meters, lens)
+    ok = (bm_meters < lens + 50) & (e > s)
+    if not ok.any(): return out
+    
+    lines = vertex_substring(net, f[ok], s[ok], e[ok])
+    far = shapely.distance(shapely.get_point(lines, 0), shapely.get_point(lines, -1)) > 0.1
+    out[np.flatnonzero(ok)[far]] = lines[far]
+    return out
+
+def process_batch(df_batch, network, col_map, mode, ref_lookup=None):
     rid_col = col_map['rid']
     bm_col = col_map['bm']
     em_col = col_map['em']
-    gis_rid = col_map['gis_rid']
+    unit_factor = 1609.34
+    n = len(df_batch)
     
-    routes[gis_rid] = routes[gis_rid].astype(str)
-    df_batch[rid_col] = df_batch[rid_col].astype(str)
+    # --- Column-wise inputs (NaN marks an unparseable measure) ---
+    rids = df_batch[rid_col].to_numpy()
+    bm_raw = df_batch[bm_col]
+    em_raw = df_batch[em_col] if em_col in df_batch.columns else pd.Series([None] * n, index=df_batch.index, dtype=object)
+    bm = pd.to_numeric(bm_raw, errors='coerce').to_numpy(dtype=float)
+    em = pd.to_numeric(em_raw, errors='coerce').to_numpy(dtype=float)
+    em_missing = em_raw.isna().to_numpy()
     
-    v_pts, v_lns, errs = [], [], []
-    unit_factor = 1609.34
+    # Official limits aligned to rows; NaN where the route has no reference entry
+    limits = (ref_lookup if ref_lookup is not None else pd.DataFrame(columns=['min', 'max'], dtype=float)).reindex(rids)
+    r_min = limits['min'].to_numpy(dtype=float)
+    r_max = limits['max'].to_numpy(dtype=float)
+    has_ref = ~np.isnan(r_min)
     
-    for idx, row in df_batch.iterrows():
-        try:
-            rid = str(row[rid_col]).strip()
-            
-            route_min_mp = 0.0
-            if ref_lookup and rid in ref_lookup:
-                limits = ref_lookup[rid]
-                route_min_mp = limits['min'] 
-                
-                try: bm_val = float(row[bm_col])
-                except: raise ValueError(f"Invalid Begin Measure format: {row[bm_col]}")
-                
-                if bm_val < limits['min']:
-                    raise ValueError(f"Begin MP ({bm_val}) is below Route {rid} Minimum ({limits['min']})")
-                if bm_val > limits['max']:
-                    raise ValueError(f"Begin MP ({bm_val}) exceeds Route {rid} Maximum ({limits['max']})")
-                
-                if mode != 'Point' and em_col != '(None)' and not pd.isna(row.get(em_col)):
-                    try: em_val = float(row[em_col])
-                    except: raise ValueError(f"Invalid End Measure format: {row.get(em_col)}")
-                    
-                    if em_val > limits['max']:
-                         if em_val > (limits['max'] + 0.1): 
-                             raise ValueError(f"End MP ({em_val}) exceeds Route {rid} Maximum ({limits['max']})")
-
-            matches = routes[routes[gis_rid] == rid]
-            if matches.empty:
-                raise ValueError(f"Route ID '{rid}' Not Found in GIS Network")
-            
-            try: bm_val = float(row[bm_col])
-            except: raise ValueError(f"Invalid Begin Measure: {row[bm_col]}")
-            
-            is_point = False
-            if mode == 'Point': is_point = True
-            elif mode == 'Line': is_point = False
-            else:
-                if em_col == '(None)' or pd.isna(row.get(em_col)): is_point = True
-            
-            final_geom = None
-            
-            for _, feat in matches.iterrows():
-                geom = feat.geometry
-                
-                if geom.geom_type == 'MultiLineString':
-                    merged = linemerge(geom)
-                    if merged.geom_type in ['LineString', 'MultiLineString']:
-                        geom = merged
-                
-                relative_bm = max(0.0, bm_val - route_min_mp)
-                bm_meters = relative_bm * unit_factor
-                
-                if is_point:
-                    if bm_meters <= geom.length:
-                        final_geom = geom.interpolate(bm_meters)
-                        break
-                else:
-                    try: em_val = float(row[em_col])
-                    except: raise ValueError(f"Invalid End Measure: {row.get(em_col)}")
-                    
-                    relative_em = max(0.0, em_val - route_min_mp)
-                    em_meters = relative_em * unit_factor
-                    
-                    if bm_meters >= em_meters:
-                        if bm_meters == em_meters: raise ValueError("Begin MP == End MP (Use Point mode)")
-                        else: raise ValueError(f"End MP ({em_val}) < Begin MP ({bm_val})")
-                    
-                    try:
-                        candidate_ln = substring(geom, bm_meters, em_meters)
-                        if not candidate_ln.is_empty and candidate_ln.geom_type in ['LineString', 'MultiLineString'] and candidate_ln.length > 0.1:
-                            final_geom = candidate_ln
-                            break 
-                    except: pass
-                    
-                    if bm_meters < (geom.length + 50): 
-                         actual_end_m = min(em_meters, geom.length)
-                         actual_start_m = min(bm_meters, geom.length)
-                         
-                         if actual_end_m > actual_start_m:
-                             segment_len = actual_end_m - actual_start_m
-                             num_points = max(2, int(segment_len / 10))
-                             distances = np.linspace(actual_start_m, actual_end_m, num=num_points)
-                             points = [geom.interpolate(d) for d in distances]
-                             
-                             if points[0].distance(points[-1]) > 0.1:
-                                 final_geom = LineString(points)
-                                 break 
-
-            if final_geom is None:
-                 if is_point:
-                     last_geom = matches.iloc[-1].geometry
-                     if (bm_val - route_min_mp) * unit_factor > last_geom.length:
-                         final_geom = last_geom.interpolate(last_geom.length)
-                     else:
-                         raise ValueError("Measure out of range of all found route segments.")
-                 else:
-                     raise ValueError("Could not generate geometry. Segment likely falls in a gap or outside GIS limits.")
-
-            res = row.copy()
-            res['geometry'] = final_geom
-            if 'Error_Message' in res: del res['Error_Message']
-            
-            if is_point: v_pts.append(res)
-            else: v_lns.append(res)
-
-        except Exception as e:
-            row['Error_Message'] = str(e)
-            errs.append(row)
+    # --- Rows resolved to their route once; everything below works on route codes ---
+    net = network.net
+    codes = network.index.get_indexer(rids)
+    found = codes >= 0
+    feat_table, n_feat = net['feat_table'], net['n_feat']
+    
+    # --- Validation masks; the first failing check sets a row's message ---
+    err_msgs = np.empty(n, dtype=object)
+    def flag(mask, make_msg):
+        for k in np.flatnonzero(mask & pd.isna(err_msgs)):
+            err_msgs[k] = make_msg(k)
+    
+    bm_bad = np.isnan(bm)
+    flag(has_ref & bm_bad, lambda k: f"Invalid Begin Measure format: {bm_raw.iat[k]}")
+    flag(has_ref & (bm < r_min), lambda k: f"Begin MP ({bm[k]}) is below Route {rids[k]} Minimum ({r_min[k]})")
+    flag(has_ref & (bm > r_max), lambda k: f"Begin MP ({bm[k]}) exceeds Route {rids[k]} Maximum ({r_max[k]})")
+    if mode != 'Point' and em_col != '(None)':
+        flag(has_ref & ~em_missing & np.isnan(em), lambda k: f"Invalid End Measure format: {em_raw.iat[k]}")
+        flag(has_ref & ~em_missing & (em > r_max + 0.1), lambda k: f"End MP ({em[k]}) exceeds Route {rids[k]} Maximum ({r_max[k]})")
+    flag(~found, lambda k: f"Route ID '{rids[k]}' Not Found in GIS Network")
+    flag(bm_bad, lambda k: f"Invalid Begin Measure: {bm_raw.iat[k]}")
+    
+    if mode == 'Point': is_pt = np.ones(n, dtype=bool)
+    elif mode == 'Line': is_pt = np.zeros(n, dtype=bool)
+    else: is_pt = em_missing.copy()
+    
+    route_min = np.where(has_ref, r_min, 0.0)
+    bm_m = np.maximum(0.0, bm - route_min) * unit_factor
+    em_m = np.maximum(0.0, em - route_min) * unit_factor
+    
+    flag(~is_pt & np.isnan(em), lambda k: f"Invalid End Measure: {em_raw.iat[k]}")
+    flag(~is_pt & (bm_m == em_m), lambda k: "Begin MP == End MP (Use Point mode)")
+    flag(~is_pt & (bm_m > em_m), lambda k: f"End MP ({em[k]}) < Begin MP ({bm[k]})")
+    
+    geoms = np.empty(n, dtype=object)
+    
+    # --- Points: pick each row's feature, then interpolate all rows in one call ---
+    pt_rows = np.flatnonzero(pd.isna(err_msgs) & is_pt)
+    seg = find_segs(feat_table, net['lens'], codes[pt_rows], bm_m[pt_rows])
+    hit, miss = pt_rows[seg >= 0], pt_rows[seg < 0]
+    if len(hit):
+        chosen = feat_table[codes[hit], seg[seg >= 0]]
+        geoms[hit] = interpolate_points(net, chosen, bm_m[hit])
+    
+    # Past the end of every feature: snap to the end of the route's last feature
+    if len(miss):
+        last = feat_table[codes[miss], n_feat[codes[miss]] - 1]
+        past_end = (bm[miss] - route_min[miss]) * unit_factor > net['lens'][last]
+        geoms[miss[past_end]] = interpolate_points(net, last[past_end], net['lens'][last[past_end]])
+        err_msgs[miss[~past_end]] = "Measure out of range of all found route segments."
+    
+    # --- Lines: try each row's features in order; substring in one batch, then resample ---
+    pending = np.flatnonzero(pd.isna(err_msgs) & ~is_pt)
+    j = 0
+    while len(pending):
+        has_feat = n_feat[codes[pending]] > j
+        err_msgs[pending[~has_feat]] = "Could not generate geometry. Segment likely falls in a gap or outside GIS limits."
+        pending = pending[has_feat]
+        if not len(pending): break
+        cand = feat_table[codes[pending], j]
+        sub = batch_substring(net, cand, bm_m[pending], em_m[pending])
+        good = pd.notna(sub)
+        geoms[pending[good]] = sub[good]
+        rest = pending[~good]
+        geoms[rest] = batch_fallback_line(net, cand[~good], bm_m[rest], em_m[rest])
+        pending = rest[pd.isna(geoms[rest])]
+        j += 1
+    
+    ok = pd.isna(err_msgs)
+    out = df_batch.drop(columns='Error_Message', errors='ignore')
+    v_pts = gpd.GeoDataFrame(out[ok & is_pt].assign(geometry=geoms[ok & is_pt]), crs=CALC_CRS)
+    v_lns = gpd.GeoDataFrame(out[ok & ~is_pt].assign(geometry=geoms[ok & ~is_pt]), crs=CALC_CRS)
+    errs = df_batch[~ok].assign(Error_Message=err_msgs[~ok])
             
     return v_pts, v_lns, errs
 
+def process_parallel(df_batch, network, col_map, mode, ref_lookup=None):
+    # GEOS and numpy release the GIL, so large inputs run as row chunks on threads sharing one network
+    n_jobs = min(os.cpu_count() or 1, -(-len(df_batch) // PARALLEL_MIN_ROWS))
+    if n_jobs <= 1: return process_batch(df_batch, network, col_map, mode, ref_lookup)
+    chunks = np.array_split(np.arange(len(df_batch)), n_jobs)
+    with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+        parts = list(ex.map(lambda c: process_batch(df_batch.iloc[c], network, col_map, mode, ref_lookup), chunks))
+    return tuple(pd.concat(p) for p in zip(*parts))
+
 # --- UI SECTION 1: UPLOAD ---
 st.subheader("1. Data Upload")
 uploaded_file = st.file_uploader("Upload Data (.csv or .xlsx)", type=["csv", "xlsx"])
@@ -389,11 +712,11 @@ df_main = None
 if uploaded_file:
     try:
         if uploaded_file.name.endswith('.csv'):
-            df_main = pd.read_csv(uploaded_file)
+            df_main = read_csv_upload(uploaded_file)
             default_out_name = os.path.splitext(uploaded_file.name)[0]
         else:
-            xls = pd.ExcelFile(uploaded_file)
-            df_main = pd.read_excel(uploaded_file, sheet_name=0)
+            # Rust-based calamine parser when installed; openpyxl otherwise
+            df_main = pd.read_excel(uploaded_file, sheet_name=0, engine='calamine' if CALAMINE_AVAILABLE else None)
             default_out_name = os.path.splitext(uploaded_file.name)[0]
     except Exception as e:
         st.error(f"Error reading input file: {e}")
@@ -428,44 +751,38 @@ if df_main is not None:
 
     before_len = len(df_main)
     df_main = df_main.dropna(subset=[rid_col, bm_col], how='any')
-    if len(df_main) > 0:
-        mask = df_main[rid_col].astype(str).str.strip() == ''
-        df_main = df_main[~mask]
+    # Route IDs are normalized once here so process_batch can compare them directly
+    df_main[rid_col] = normalize_rid(df_main[rid_col])
+    df_main = df_main[df_main[rid_col] != '']
     
     st.divider()
     
     if st.button("🚀 Run Analysis", type="primary"):
-        st.session_state['success_pts'] = []
-        st.session_state['success_lns'] = []
+        st.session_state['pts_gdf_out'] = None
+        st.session_state['lns_gdf_out'] = None
         st.session_state['error_df'] = None
+        st.session_state['map_html'] = None
         
-        raw_routes = get_arcgis_features(ROUTE_SERVICE_URL)
-        if raw_routes is None: st.stop()
-        routes = raw_routes.to_crs(CALC_CRS)
+        network = load_route_network()
+        if network is None: st.stop()
         
         with st.spinner("Loading Official Route Limits..."):
             ref_lookup = get_reference_data(REF_SHEET_URL)
         
-        gis_rid = None
-        for c in routes.columns:
-            if c.upper() in ['ROUTE', 'ROUTEID', 'RTEID', 'ROUTE_ID']:
-                gis_rid = c; break
-        if not gis_rid: gis_rid = routes.columns[0]
-        
-        col_map = {'rid': rid_col, 'bm': bm_col, 'em': em_col, 'gis_rid': gis_rid}
+        col_map = {'rid': rid_col, 'bm': bm_col, 'em': em_col, 'gis_rid': network.gis_rid}
         st.session_state['col_map'] = col_map
         st.session_state['ref_lookup'] = ref_lookup
         
         with st.spinner("Processing..."):
-            pts, lns, errs = process_batch(
-                df_main, routes, col_map, mode, ref_lookup
+            pts, lns, errs = process_parallel(
+                df_main, network, col_map, mode, ref_lookup
             )
             
-            st.session_state['success_pts'] = pts
-            st.session_state['success_lns'] = lns
-            if errs:
-                err_df = pd.DataFrame(errs)
-                err_df = err_df.sort_values('Error_Message')
+            # Only the projected copies are kept per session; map, downloads and uploads all read these
+            st.session_state['pts_gdf_out'] = pts.to_crs(MAP_CRS)
+            st.session_state['lns_gdf_out'] = lns.to_crs(MAP_CRS)
+            if not errs.empty:
+                err_df = errs.sort_values('Error_Message')
                 cols = list(err_df.columns)
                 cols.insert(0, cols.pop(cols.index('Error_Message')))
                 st.session_state['error_df'] = err_df[cols]
@@ -484,21 +801,22 @@ if st.session_state['processed']:
         col_fix, col_skip = st.columns([1, 4])
         with col_fix:
             if st.button("🔄 Re-Run Fixes"):
-                raw_routes = get_arcgis_features(ROUTE_SERVICE_URL)
-                routes = raw_routes.to_crs(CALC_CRS)
+                network = load_route_network()
+                if network is None: st.stop()
                 col_map = st.session_state['col_map']
                 ref_lookup = st.session_state.get('ref_lookup', None)
+                edited_errors[col_map['rid']] = normalize_rid(edited_errors[col_map['rid']])
                 
                 with st.spinner("Re-processing fixes..."):
-                    new_pts, new_lns, new_errs = process_batch(
-                        edited_errors, routes, col_map, mode, ref_lookup
+                    new_pts, new_lns, new_errs = process_parallel(
+                        edited_errors, network, col_map, mode, ref_lookup
                     )
-                    st.session_state['success_pts'].extend(new_pts)
-                    st.session_state['success_lns'].extend(new_lns)
+                    st.session_state['pts_gdf_out'] = pd.concat([st.session_state['pts_gdf_out'], new_pts.to_crs(MAP_CRS)])
+                    st.session_state['lns_gdf_out'] = pd.concat([st.session_state['lns_gdf_out'], new_lns.to_crs(MAP_CRS)])
+                    st.session_state['map_html'] = None
                     
-                    if new_errs:
-                        err_df = pd.DataFrame(new_errs)
-                        err_df = err_df.sort_values('Error_Message')
+                    if not new_errs.empty:
+                        err_df = new_errs.sort_values('Error_Message')
                         cols = list(err_df.columns)
                         if 'Error_Message' in cols: cols.insert(0, cols.pop(cols.index('Error_Message')))
                         st.session_state['error_df'] = err_df[cols]
@@ -511,8 +829,8 @@ if st.session_state['processed']:
     st.divider()
     st.subheader("3. Results & Download")
     
-    n_pts = len(st.session_state['success_pts'])
-    n_lns = len(st.session_state['success_lns'])
+    n_pts = len(st.session_state['pts_gdf_out']) if st.session_state['pts_gdf_out'] is not None else 0
+    n_lns = len(st.session_state['lns_gdf_out']) if st.session_state['lns_gdf_out'] is not None else 0
     n_err = len(st.session_state['error_df']) if st.session_state['error_df'] is not None else 0
     
     m1, m2, m3 = st.columns(3)
@@ -520,57 +838,11 @@ if st.session_state['processed']:
     m2.metric("Mapped Lines", n_lns)
     m3.metric("Remaining Errors", n_err, delta_color="inverse")
     
-    m = folium.Map(location=[39.1, -105.5], zoom_start=7, prefer_canvas=True)
-    
-    if n_pts > 0:
-        valid_pts = [p for p in st.session_state['success_pts'] if p['geometry'] is not None]
-        if valid_pts:
-            pts_gdf = gpd.GeoDataFrame(valid_pts, crs=CALC_CRS).to_crs(MAP_CRS)
-            for col in pts_gdf.columns:
-                if pd.api.types.is_datetime64_any_dtype(pts_gdf[col]):
-                    pts_gdf[col] = pts_gdf[col].astype(str)
-
-            folium.GeoJson(
-                pts_gdf,
-                name="Mapped Points",
-                point_to_layer=JsCode(f"""
-                    function(feature, latlng) {{
-                        return L.circleMarker(latlng, {{
-                            radius: 5,
-                            fillColor: '{feature_color}',
-                            color: 'white',
-                            weight: 1,
-                            opacity: 1,
-                            fillOpacity: 0.8
-                        }});
-                    }}
-                """),
-                popup=folium.GeoJsonPopup(
-                    fields=[c for c in pts_gdf.columns if c != 'geometry'],
-                    style="max-width: 400px; max-height: 300px; overflow-y: auto; display: block;"
-                )
-            ).add_to(m)
-
-    if n_lns > 0:
-        valid_lns = [l for l in st.session_state['success_lns'] if l['geometry'] is not None]
-        if valid_lns:
-            lns_gdf = gpd.GeoDataFrame(valid_lns, crs=CALC_CRS).to_crs(MAP_CRS)
-            for col in lns_gdf.columns:
-                if pd.api.types.is_datetime64_any_dtype(lns_gdf[col]):
-                    lns_gdf[col] = lns_gdf[col].astype(str)
-            
-            folium.GeoJson(
-                lns_gdf,
-                name="Mapped Lines",
-                style_function=lambda x: {'color': feature_color, 'weight': 3},
-                popup=folium.GeoJsonPopup(
-                    fields=[c for c in lns_gdf.columns if c != 'geometry'],
-                    style="max-width: 400px; max-height: 300px; overflow-y: auto; display: block;"
-                )
-            ).add_to(m)
-
-    folium.LayerControl().add_to(m)
-    st_folium(m, width=1000, height=600)
+    # Rendered HTML is reused across reruns until the results or the color change
+    if st.session_state['map_html'] is None or st.session_state['map_color'] != feature_color:
+        st.session_state['map_html'] = build_map_html(st.session_state['pts_gdf_out'], st.session_state['lns_gdf_out'], feature_color)
+        st.session_state['map_color'] = feature_color
+    components.html(st.session_state['map_html'], width=1000, height=600)
     
     # --- DOWNLOAD & UPLOAD SECTION ---
     st.divider()
@@ -580,7 +852,7 @@ if st.session_state['processed']:
     
     with col_dl:
         st.write("##### 💾 Download Local Files")
-        dl_fmt = st.radio("Format:", ["Shapefile (ZIP)", "GeoPackage (.gpkg)"], horizontal=True)
+        dl_fmt = st.radio("Format:", ["Shapefile (ZIP)", "GeoPackage (.gpkg)", "GeoParquet (ZIP)"], horizontal=True)
         
         # --- DOWNLOAD HANDLER ---
         file_ready = False
@@ -590,27 +862,27 @@ if st.session_state['processed']:
         
         if dl_fmt == "Shapefile (ZIP)":
             zip_buffer = io.BytesIO()
-            with ZipFile(zip_buffer, 'w') as zipf:
+            with ZipFile(zip_buffer, 'w', compression=ZIP_DEFLATED, compresslevel=1) as zipf:
                 if n_err > 0:
                     csv_data = st.session_state['error_df'].to_csv(index=False)
                     zipf.writestr("Remaining_Errors.csv", csv_data)
                 
-                def save_shp(data, suffix):
-                    valid_data = [d for d in data if d.get('geometry') is not None]
-                    if not valid_data: return
-                    tmp_gdf = gpd.GeoDataFrame(valid_data, crs=CALC_CRS).to_crs(MAP_CRS)
-                    for col in tmp_gdf.columns:
-                        if tmp_gdf[col].dtype == 'object': tmp_gdf[col] = tmp_gdf[col].astype(str)
+                def save_shp(gdf, suffix):
+                    if gdf is None or gdf.empty: return
+                    tmp_gdf = stringify_datetimes(gdf.copy())
+                    obj_cols = tmp_gdf.select_dtypes(include='object').columns
+                    if len(obj_cols): tmp_gdf[obj_cols] = tmp_gdf[obj_cols].astype(str)
                     name = f"{out_name}_{suffix}"
-                    path = f"/tmp/{name}.shp"
-                    tmp_gdf.to_file(path)
-                    for f in os.listdir("/tmp"):
-                        if f.startswith(name):
-                            zipf.write(os.path.join("/tmp", f), f)
-                            os.remove(os.path.join("/tmp", f))
-
-                save_shp(st.session_state['success_pts'], "Points")
-                save_shp(st.session_state['success_lns'], "Lines")
+                    # GDAL writes the shapefile pre-zipped (.shp.zip); its members are copied straight into the export
+                    with tempfile.TemporaryDirectory() as tmp_dir:
+                        shz_path = os.path.join(tmp_dir, f"{name}.shp.zip")
+                        pyogrio.write_dataframe(tmp_gdf, shz_path, driver="ESRI Shapefile")
+                        with ZipFile(shz_path) as shz:
+                            for info in shz.infolist():
+                                zipf.writestr(info, shz.read(info), compresslevel=1)
+
+                save_shp(st.session_state['pts_gdf_out'], "Points")
+                save_shp(st.session_state['lns_gdf_out'], "Lines")
             
             dl_data = zip_buffer.getvalue()
             dl_name = f"{out_name}.zip"
@@ -618,30 +890,46 @@ if st.session_state['processed']:
             file_ready = True
             
         elif dl_fmt == "GeoPackage (.gpkg)":
-            gpkg_path = f"/tmp/{out_name}.gpkg"
-            if os.path.exists(gpkg_path): os.remove(gpkg_path)
-            
-            has_layers = False
-            if n_pts > 0:
-                valid_pts = [d for d in st.session_state['success_pts'] if d.get('geometry') is not None]
-                if valid_pts:
-                    gpd.GeoDataFrame(valid_pts, crs=CALC_CRS).to_crs(MAP_CRS).to_file(gpkg_path, layer="Points", driver="GPKG")
-                    has_layers = True
+            # Single-layer packages go straight into memory; two layers need GDAL's append, which wants a real file
+            if (n_pts > 0) != (n_lns > 0):
+                gpkg_buffer = io.BytesIO()
+                gdf, layer = (st.session_state['pts_gdf_out'], "Points") if n_pts > 0 else (st.session_state['lns_gdf_out'], "Lines")
+                pyogrio.write_dataframe(gdf, gpkg_buffer, layer=layer, driver="GPKG")
+                dl_data = gpkg_buffer.getvalue()
+            elif n_pts > 0:
+                # Private temp dir per download, so sessions exporting the same name can't collide
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    gpkg_path = os.path.join(tmp_dir, f"{out_name}.gpkg")
+                    pyogrio.write_dataframe(st.session_state['pts_gdf_out'], gpkg_path, layer="Points", driver="GPKG")
+                    pyogrio.write_dataframe(st.session_state['lns_gdf_out'], gpkg_path, layer="Lines", driver="GPKG", append=True)
+                    with open(gpkg_path, "rb") as f:
+                        dl_data = f.read()
             
-            if n_lns > 0:
-                valid_lns = [d for d in st.session_state['success_lns'] if d.get('geometry') is not None]
-                if valid_lns:
-                    mode = 'a' if has_layers else 'w'
-                    gpd.GeoDataFrame(valid_lns, crs=CALC_CRS).to_crs(MAP_CRS).to_file(gpkg_path, layer="Lines", driver="GPKG", mode=mode)
-                    has_layers = True
-            
-            if has_layers:
-                with open(gpkg_path, "rb") as f:
-                    dl_data = f.read()
+            if dl_data is not None:
                 dl_name = f"{out_name}.gpkg"
                 dl_mime = "application/octet-stream"
                 file_ready = True
 
+        elif dl_fmt == "GeoParquet (ZIP)":
+            # Parquet is already zstd-compressed, so the archive just stores it
+            zip_buffer = io.BytesIO()
+            with ZipFile(zip_buffer, 'w', compression=ZIP_STORED) as zipf:
+                if n_err > 0:
+                    zipf.writestr("Remaining_Errors.csv", st.session_state['error_df'].to_csv(index=False))
+                for gdf, suffix in [(st.session_state['pts_gdf_out'], "Points"), (st.session_state['lns_gdf_out'], "Lines")]:
+                    if gdf is None or gdf.empty: continue
+                    # Mixed-type object columns (e.g. Excel MPs with typos) have no single Arrow type
+                    obj_cols = gdf.select_dtypes(include='object').columns
+                    if len(obj_cols): gdf = gdf.assign(**{c: gdf[c].astype(str) for c in obj_cols})
+                    pq_buffer = io.BytesIO()
+                    gdf.to_parquet(pq_buffer, compression="zstd")
+                    zipf.writestr(f"{out_name}_{suffix}.parquet", pq_buffer.getvalue())
+            
+            dl_data = zip_buffer.getvalue()
+            dl_name = f"{out_name}_parquet.zip"
+            dl_mime = "application/zip"
+            file_ready = True
+
         if file_ready:
             st.download_button(
                 label=f"📦 Download {dl_fmt}",
@@ -651,7 +939,9 @@ if st.session_state['processed']:
                 type="primary"
             )
 
-    with col_ul:
+    # The upload panel reruns on its own, so login/logout and form edits don't replay the whole script
+    @st.fragment
+    def upload_panel():
         if ARCGIS_AVAILABLE:
             with st.expander("☁️ Upload to ArcGIS / GeoHub", expanded=False):
                 # LOGIN UI
@@ -672,26 +962,27 @@ if st.session_state['processed']:
                     
                     if st.button("Connect"):
                         try:
-                            gis = GIS(p_url, p_user, p_pass, verify_cert=not disable_ssl)
+                            gis = get_gis(p_url, p_user, p_pass, hashlib.sha256(p_pass.encode()).hexdigest(), not disable_ssl)
                             st.session_state['gis'] = gis
                             st.session_state['agol_creds'] = (p_url, p_user, p_pass)
                             
                             with st.spinner("Fetching content & folders..."):
-                                # Fetch Content
+                                # Content search and folder listing are independent portal calls, so they run side by side
                                 query = f"owner:{p_user} AND type:\"Feature Service\""
-                                user_content = gis.content.search(query=query, max_items=200)
+                                with ThreadPoolExecutor(max_workers=2) as ex:
+                                    content_job = ex.submit(gis.content.search, query=query, max_items=200)
+                                    folders_job = ex.submit(lambda: gis.users.me.folders)
+                                
                                 # Store Sorted Tuple List (Title, ID) for cleaner dropdown
-                                content_list = [(item.title, item.id) for item in user_content]
+                                content_list = [(item.title, item.id) for item in content_job.result()]
                                 content_list.sort(key=lambda x: x[0])
                                 st.session_state['user_layers'] = content_list
                                 
-                                # Fetch Folders
-                                folder_list = [f['title'] for f in gis.users.me.folders]
-                                folder_list.sort()
-                                st.session_state['user_folders'] = folder_list
+                                # Folders, case-insensitive so 'archive' doesn't sort after 'Zoning'
+                                st.session_state['user_folders'] = sorted((f['title'] for f in folders_job.result()), key=str.lower)
 
                             st.success(f"Connected as {gis.users.me.username}")
-                            st.rerun()
+                            st.rerun(scope="fragment")
                         except Exception as e:
                             st.error(f"Login Failed: {e}")
                 
@@ -701,7 +992,7 @@ if st.session_state['processed']:
                     st.success(f"Logged in as: **{gis.users.me.username}**")
                     if st.button("Logout"):
                         st.session_state['gis'] = None
-                        st.rerun()
+                        st.rerun(scope="fragment")
                     
                     st.divider()
                     
@@ -738,27 +1029,35 @@ if st.session_state['processed']:
                             selected_folder_name = None # Root
                         
                         item_props = {'tags': up_tags, 'snippet': up_summary}
-                        ready_to_upload = True
+                        # Publishing with a blank (or, for dual uploads, shared) name can only fail on the portal
+                        if (n_pts > 0 and n_lns > 0): ready_to_upload = bool(up_name_pts.strip() and up_name_lns.strip()) and up_name_pts != up_name_lns
+                        else: ready_to_upload = bool(up_name.strip())
                         
                     else:
                         # OVERWRITE MODE
                         st.markdown('<div class="warning-box">⚠️ <b>DANGER ZONE:</b> Overwriting replaces the entire dataset. This can break maps, dashboards, and apps that rely on specific field names or data.</div>', unsafe_allow_html=True)
                         
                         if st.session_state['user_layers']:
-                            # CLEANER DROPDOWN: Shows "Title" only, maps back to ID
-                            layer_options = [x[0] for x in st.session_state['user_layers']]
-                            selected_title = st.selectbox("Select Layer to Overwrite", layer_options)
-                            
-                            # Find ID for selected title
-                            target_item_id = next((x[1] for x in st.session_state['user_layers'] if x[0] == selected_title), None)
+                            # CLEANER DROPDOWN: Shows "Title" only, but the selection is the (Title, ID) pair itself,
+                            # so no lookup is needed and layers sharing a title stay distinct
+                            selected_title, target_item_id = st.selectbox("Select Layer to Overwrite", st.session_state['user_layers'], format_func=lambda x: x[0])
                             up_name = selected_title # Just for labelling
                             
                             # Pre-check schema
                             if n_lns > 0 or n_pts > 0:
-                                sample_data = st.session_state['success_lns'] if n_lns > 0 else st.session_state['success_pts']
-                                zip_path_check, new_cols = prep_geopackage_zip(sample_data, "schema_check")
+                                sample_data = st.session_state['lns_gdf_out'] if n_lns > 0 else st.session_state['pts_gdf_out']
+                                # Same field list prep_geopackage_zip would publish; no need to build a package to read it
+                                new_cols = list(sample_data.columns)
                                 
-                                status, missing = check_schema_match(gis, target_item_id, new_cols)
+                                # Portal lookup only when the target layer or the columns change, not on every rerun.
+                                # A failed lookup (UNKNOWN) is not kept, so the next rerun asks the portal again.
+                                schema_key = (target_item_id, tuple(new_cols))
+                                cached = st.session_state['schema_check']
+                                if cached is not None and cached[0] == schema_key:
+                                    status, missing = cached[1]
+                                else:
+                                    status, missing = check_schema_match(gis, target_item_id, new_cols)
+                                    st.session_state['schema_check'] = (schema_key, (status, missing)) if status != "UNKNOWN" else None
                                 
                                 if status == "MISMATCH":
                                     st.error(f"❌ **SCHEMA MISMATCH DETECTED**")
@@ -776,36 +1075,40 @@ if st.session_state['processed']:
                         with st.spinner("Processing Upload..."):
                             
                             if up_mode == "New Layer" and (n_pts > 0 and n_lns > 0):
-                                # Dual Upload
-                                zip_path, _ = prep_geopackage_zip(st.session_state['success_pts'], up_name_pts)
-                                if zip_path:
-                                    status, msg = handle_arcgis_upload(gis, zip_path, up_name_pts, selected_folder_name, item_props, None)
-                                    if status in ["PUBLISHED", "OVERWRITTEN"]: st.success(f"Points {status}: [View Item]({msg})")
-                                    else: st.error(f"Points Error: {msg}")
-                                    
-                                zip_path, _ = prep_geopackage_zip(st.session_state['success_lns'], up_name_lns)
-                                if zip_path:
-                                    status, msg = handle_arcgis_upload(gis, zip_path, up_name_lns, selected_folder_name, item_props, None)
-                                    if status in ["PUBLISHED", "OVERWRITTEN"]: st.success(f"Lines {status}: [View Item]({msg})")
-                                    else: st.error(f"Lines Error: {msg}")
+                                # Dual Upload: the two layers publish independently, so both run at once.
+                                # A new folder is created first so the two uploads don't race to create it.
+                                if selected_folder_name:
+                                    try:
+                                        if selected_folder_name not in {f['title'] for f in gis.users.me.folders}:
+                                            gis.content.create_folder(selected_folder_name)
+                                    except: pass
+                                
+                                jobs = [("Points", st.session_state['pts_gdf_out'], up_name_pts), ("Lines", st.session_state['lns_gdf_out'], up_name_lns)]
+                                with ThreadPoolExecutor(max_workers=2) as ex:
+                                    results = list(ex.map(lambda j: zip_and_upload(gis, j[1], j[2], selected_folder_name, item_props), jobs))
+                                
+                                for (label, _, _), (status, msg) in zip(jobs, results):
+                                    if status is None: continue
+                                    if status in ["PUBLISHED", "OVERWRITTEN"]:
+                                        st.session_state['schema_check'] = None
+                                        st.success(f"{label} {status}: [View Item]({msg})")
+                                    else: st.error(f"{label} Error: {msg}")
                             
                             else:
                                 # Standard Single Upload
-                                if n_pts > 0:
-                                    zip_path, _ = prep_geopackage_zip(st.session_state['success_pts'], up_name)
-                                    if zip_path:
-                                        status, msg = handle_arcgis_upload(gis, zip_path, up_name, selected_folder_name, item_props, target_item_id)
-                                        if status in ["PUBLISHED", "OVERWRITTEN"]: st.success(f"Points {status}: [View Item]({msg})")
-                                        elif status == "EXISTS": st.warning(f"Layer '{up_name}' already exists.")
-                                        else: st.error(f"Points Error: {msg}")
-                                
-                                if n_lns > 0:
-                                    zip_path, _ = prep_geopackage_zip(st.session_state['success_lns'], up_name)
-                                    if zip_path:
-                                        status, msg = handle_arcgis_upload(gis, zip_path, up_name, selected_folder_name, item_props, target_item_id)
-                                        if status in ["PUBLISHED", "OVERWRITTEN"]: st.success(f"Lines {status}: [View Item]({msg})")
-                                        elif status == "EXISTS": st.warning(f"Layer '{up_name}' already exists.")
-                                        else: st.error(f"Lines Error: {msg}")
+                                for label, gdf, n in [("Points", st.session_state['pts_gdf_out'], n_pts), ("Lines", st.session_state['lns_gdf_out'], n_lns)]:
+                                    if n == 0: continue
+                                    status, msg = zip_and_upload(gis, gdf, up_name, selected_folder_name, item_props, target_item_id)
+                                    if status is None: continue
+                                    if status in ["PUBLISHED", "OVERWRITTEN"]:
+                                        # The target's schema is now this upload's, so the stored check is stale
+                                        st.session_state['schema_check'] = None
+                                        st.success(f"{label} {status}: [View Item]({msg})")
+                                    elif status == "EXISTS": st.warning(f"Layer '{up_name}' already exists.")
+                                    else: st.error(f"{label} Error: {msg}")
         else:
             st.info("The 'arcgis' library is missing. Upload features are disabled.")
+    
+    with col_ul:
+        upload_panel()
 